@@ -1,9 +1,14 @@
 from typing import Tuple
 
 import json
+import threading
 import time
 
 from api import rest, realtime
+import recorder
+
+# Lock held while checking and refreshing the players' tokens
+tokens_lock = threading.Lock()
 
 # -------------------- Helper Functions --------------------
 
@@ -32,17 +37,19 @@ def save_player_data():
         json.dump(players, f, indent=4)
 
 # Method to check if the tokens are valid, and refresh them if not
+# The methods below may be run from several threads at once, so only one thread checks the tokens at a time
 def ensure_tokens_valid(color: str):
     global players
     global api_keys
 
-    access_token, refresh_token = rest.verify_tokens(players[color]['access_token'], players[color]['refresh_token'], players[color]['name'], api_keys[0], api_keys[1])
+    with tokens_lock:
+        access_token, refresh_token = rest.verify_tokens(players[color]['access_token'], players[color]['refresh_token'], players[color]['name'], api_keys[0], api_keys[1])
 
-    players[color]['access_token'] = access_token
-    players[color]['refresh_token'] = refresh_token
+        players[color]['access_token'] = access_token
+        players[color]['refresh_token'] = refresh_token
 
-    # Save new tokens for next run
-    save_player_data()
+        # Save new tokens for next run
+        save_player_data()
 
 # -------------------- Implementation --------------------
 def load_config(client_id: str, client_secret: str):
@@ -80,6 +87,7 @@ def disconnect():
 # Method to pass in the given game
 # if last_pass is True, then the game is now over and will automatically be ended
 # Returns True if everything was successful
+@recorder.recorded('ogs')
 def pass_move(game_id: int, color: str, last_pass: bool) -> bool:
     global players
 
@@ -104,6 +112,7 @@ def pass_move(game_id: int, color: str, last_pass: bool) -> bool:
 
 # Method to make a move in the given game
 # Returns True if the move was made successfully
+@recorder.recorded('ogs')
 def make_move(game_id: int, color: str, move: str) -> bool:
     global players
 
@@ -113,6 +122,7 @@ def make_move(game_id: int, color: str, move: str) -> bool:
 
 # Method to start a game between the 2 players
 # Returns the id of the new game, or -1 in the case of an error
+@recorder.recorded('ogs')
 def start_game() -> int:
     global players
 
@@ -138,6 +148,7 @@ def start_game() -> int:
 
 # Method to resign a given game
 # Returns True if the resignation was successful
+@recorder.recorded('ogs')
 def resign(game_id: int, color: str) -> bool:
     global players
 
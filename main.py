@@ -1,4 +1,7 @@
-from typing import List
+from typing import List, Union
+import asyncio
+import contextvars
+import functools
 import json
 import re
 
@@ -6,6 +9,8 @@ import discord
 from discord.ext import commands
 
 import game_manager
+import rate_limit
+import recorder
 
 # Initialize bot
 bot = commands.Bot(command_prefix='!')
@@ -37,6 +42,81 @@ def allowed_channel(channel: 'Channel') -> bool:
         return True
     return channel.name in settings['discord_channels']
 
+# Method to check if a command should be handled under the per user, channel, and guild rate limits
+def admit_command(ctx) -> bool:
+    guild_id = ctx.guild.id if ctx.guild is not None else None
+    return rate_limit.admit(ctx.author.id, ctx.channel.id, guild_id)
+
+# Method to check if a reaction should be handled under the per user, channel, and guild rate limits
+def admit_reaction(reaction, user) -> bool:
+    guild = reaction.message.guild
+    guild_id = guild.id if guild is not None else None
+    return rate_limit.admit(user.id, reaction.message.channel.id, guild_id)
+
+# Method to run a blocking function, such as the game_manager methods that call the OGS api, without blocking the bot
+# The context is copied so the recorder can match the call to the event that made it
+async def run_blocking(func, *args):
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(context.run, func, *args))
+
+# Method to get the lock that must be held while reading or changing the state of a game
+# The lock is held while waiting on the OGS api, so moves in the same game can't interleave
+def get_game_lock(game_id: int) -> asyncio.Lock:
+    global game_locks
+
+    if game_id not in game_locks:
+        game_locks[game_id] = asyncio.Lock()
+    return game_locks[game_id]
+
+# Method to remove a game and its players from memory
+def remove_game(game_id: int):
+    global names_to_games
+    global game_stats
+    global game_locks
+
+    game = game_stats.pop(game_id, None)
+    if game is not None:
+        for p in game['players'][0]:
+            names_to_games.pop(p, None)
+        for p in game['players'][1]:
+            names_to_games.pop(p, None)
+
+    game_locks.pop(game_id, None)
+
+# Method to describe a command for the recorder, keeping the parts of ctx that the handlers use
+def describe_command(ctx, *args) -> dict:
+    return {
+            'user': ctx.author.mention,
+            'user_id': ctx.author.id,
+            'roles': [r.name for r in getattr(ctx.author, 'roles', [])],
+            'channel': getattr(ctx.message.channel, 'name', None),
+            'channel_id': ctx.channel.id,
+            'guild_id': ctx.guild.id if ctx.guild is not None else None,
+            'args': list(args)
+            }
+
+# Method to describe a reaction for the recorder
+# The bot's own reactions are ignored by the handler, so they aren't recorded
+# The users that have reacted are noted by the handler once it has fetched them
+def describe_reaction(reaction, user) -> Union[dict, None]:
+    if user == bot.user:
+        return None
+
+    guild = reaction.message.guild
+    return {
+            'user': user.mention,
+            'user_id': user.id,
+            'emoji': reaction.emoji,
+            'message_id': reaction.message.id,
+            'channel': getattr(reaction.message.channel, 'name', None),
+            'channel_id': reaction.message.channel.id,
+            'guild_id': guild.id if guild is not None else None,
+            'reacted': []
+            }
+
+# Message sent when an OGS operation is rejected because too many are already running
+BUSY_MESSAGE = 'The bot is busy right now, please try again shortly'
+
 
 # -------------------- Bot Functions --------------------
 
@@ -45,6 +125,7 @@ async def on_ready():
     print('Bot running')
 
 @bot.event
+@recorder.recorded('reaction', describe_reaction)
 async def on_reaction_add(reaction, user):
     if user == bot.user or not allowed_channel(reaction.message.channel):
         return
@@ -55,12 +136,18 @@ async def on_reaction_add(reaction, user):
     global waiting_reactions
     if reaction.message.id in waiting_reactions:
         # Waiting on reactions for this message, so check if everyone has done it now
+        if not admit_reaction(reaction, user):
+            return
 
         # Get a list of people that have reacted now
         have_reacted = await reaction.users().flatten()
         have_reacted = [u.mention for u in have_reacted]
+        recorder.note('reacted', have_reacted)
 
-        needed = waiting_reactions[reaction.message.id]
+        # The challenge may have been started or cancelled while fetching the reactions
+        needed = waiting_reactions.get(reaction.message.id)
+        if needed is None:
+            return
 
         # Check if this is a check mark or a x
         if reaction.emoji == '\u274c':
@@ -84,10 +171,21 @@ async def on_reaction_add(reaction, user):
             black_team = needed[:team_size]
             white_team = needed[team_size:]
 
-            game_id = game_manager.start_game()
-            
+            # Stop waiting for reactions on this message, so other reactions can't also start the game
+            waiting_reactions.pop(reaction.message.id, None)
+
+            if not rate_limit.acquire_ogs():
+                # Keep waiting so the challenge can be accepted once the bot is less busy
+                waiting_reactions[reaction.message.id] = needed
+                await reaction.message.channel.send(BUSY_MESSAGE)
+                return
+            try:
+                game_id = await run_blocking(game_manager.start_game)
+            finally:
+                rate_limit.release_ogs()
+
             if game_id == -1:
-                await reaction.message.channel.send('Error starting game')
+                await reaction.message.channel.send('Error starting game. Please start a new challenge')
             else:
                 # Game has been started, so update state accordingly
                 for u in needed:
@@ -95,13 +193,18 @@ async def on_reaction_add(reaction, user):
                     if u in names_to_games:
                         await reaction.message.channel.send(f"{u} is already in a game. Ending that game now")
                         old_game = names_to_games[u]
-                        game_manager.resign(old_game, 'black')
-
-                        for player in game_stats[old_game]['players'][0]:
-                            names_to_games.pop(player, None)
-                        for player in game_stats[old_game]['players'][1]:
-                            names_to_games.pop(player, None)
-                        game_stats.pop(old_game, None)
+                        async with get_game_lock(old_game):
+                            # The game may have already ended while waiting for the lock
+                            if old_game in game_stats:
+                                remove_game(old_game)
+
+                                if not rate_limit.acquire_ogs():
+                                    await reaction.message.channel.send(f"Unable to resign game {old_game} since the bot is busy")
+                                else:
+                                    try:
+                                        await run_blocking(game_manager.resign, old_game, 'black')
+                                    finally:
+                                        rate_limit.release_ogs()
 
                     # Assign new game to player
                     names_to_games[u] = game_id
@@ -111,52 +214,66 @@ async def on_reaction_add(reaction, user):
 
                 message = f"Game started! It can be found at https://online-go.com/game/{game_id} {' '.join(needed)}"
                 await reaction.message.channel.send(message)
-                
-                # Stop waiting for reactions on this message
-                waiting_reactions.pop(reaction.message.id, None)
 
                # Prompt the first player to make a move
                 await reaction.message.channel.send(f"{black_team[0]} it is your turn")
 
+# Not recorded, since replaying it would shut down the replay
 @bot.command(name='rengo_shutdown')
 async def shutdown(ctx):
     if not is_admin(ctx.author.roles):
         return
 
     await ctx.send('Shutting down')
-    await ctx.bot.close()
 
     # Have black resign all of the ongoing games to clean up games since they can't be renewed
-    for game in game_stats.keys():
-        game_manager.resign(game, 'black')
+    # This is done before closing the bot so the event loop is still running
+    for game in list(game_stats.keys()):
+        await run_blocking(game_manager.resign, game, 'black')
+
+    await ctx.bot.close()
 
     game_manager.disconnect()
+    recorder.close()
 
     print('Discord bot shutdown')
 
 @bot.command(name='cancel_game')
+@recorder.recorded('command', describe_command)
 async def cancel_game(ctx, game_id: int):
     if not is_admin(ctx.author.roles):
         return
 
-    if game_id not in game_stats:
-        await ctx.send(f"Invalid game {game_id}")
-        return
-
-    game = game_stats.pop(game_id)
+    async with get_game_lock(game_id):
+        if game_id not in game_stats:
+            await ctx.send(f"Invalid game {game_id}")
+            return
 
-    # Remove the players from the game and remove game stats
-    for p in game['players'][0]:
-        names_to_games.pop(p, None)
-    for p in game['players'][1]:
-        names_to_games.pop(p, None)
+        if not rate_limit.acquire_ogs():
+            await ctx.send(BUSY_MESSAGE)
+            return
+        try:
+            # Remove the players from the game and remove game stats
+            remove_game(game_id)
+
+            # Make black resign the game to clean it up
+            await run_blocking(game_manager.resign, game_id, 'black')
+        finally:
+            rate_limit.release_ogs()
+
+@bot.command(name='rengo_load')
+@recorder.recorded('command', describe_command)
+async def load_stats(ctx):
+    if not is_admin(ctx.author.roles):
+        return
 
-    # Make black resign the game to clean it up
-    game_manager.resign(game_id, 'black')
+    counts = rate_limit.get_shed_counts()
+    await ctx.send(f"Rejected commands: {', '.join(f'{k}: {v}' for k, v in counts.items())}")
 
 @bot.command(name='rengo')
+@recorder.recorded('command', describe_command)
 async def start_challenge(ctx, *args):
-    if not allowed_channel(ctx.message.channel):
+    if not allowed_channel(ctx.message.channel) or not admit_command(ctx):
         return
 
     # Get the players for the challenge
@@ -194,22 +311,12 @@ async def start_challenge(ctx, *args):
     await msg.add_reaction('\u2705')
     await msg.add_reaction('\u274c')
     waiting_reactions[msg.id] = players
+    recorder.note('message_id', msg.id)
 
-@bot.command(name='play')
-async def play(ctx, move):
-    if not allowed_channel(ctx.message.channel):
-        return
-
-    global names_to_games
-    global game_stats
-
-    # Ensure user is in a game
-    if ctx.author.mention not in names_to_games:
-        await ctx.send(f"{ctx.author.mention} you are not in a game")
-        return
-
+# Method to take a turn in the given game for the author of ctx
+# The game's lock must be held by the caller
+async def play_turn(ctx, game: int, move: str):
     # Calculate who's turn it currently is
-    game = names_to_games[ctx.author.mention]
     moves_played = game_stats[game]['num_moves']
     team_turn = moves_played % 2
     team_size = len(game_stats[game]['players'][team_turn])
@@ -228,17 +335,21 @@ async def play(ctx, move):
             #TODO fix this
             await ctx.send(f"{ctx.author.mention} ending the game by passing twice is currently not supported. Please play a move")
             return
-        if not game_manager.pass_move(game, team_color, game_stats[game]['last_pass']):
+        if not rate_limit.acquire_ogs():
+            await ctx.send(BUSY_MESSAGE)
+            return
+        try:
+            success = await run_blocking(game_manager.pass_move, game, team_color, game_stats[game]['last_pass'])
+        finally:
+            rate_limit.release_ogs()
+
+        if not success:
             await ctx.send('Error making move')
             return
 
         if game_stats[game]['last_pass']:
             # Game is over, so remove it from memory
-            for p in black_team:
-                names_to_games.pop(p, None)
-            for p in white_team:
-                names_to_games.pop(p, None)
-            game_stats.pop(game, None)
+            remove_game(game)
 
             return
 
@@ -246,7 +357,15 @@ async def play(ctx, move):
         game_stats[game]['num_moves'] += 1
 
     elif move == 'resign':
-        if not game_manager.resign(game, team_color):
+        if not rate_limit.acquire_ogs():
+            await ctx.send(BUSY_MESSAGE)
+            return
+        try:
+            success = await run_blocking(game_manager.resign, game, team_color)
+        finally:
+            rate_limit.release_ogs()
+
+        if not success:
             await ctx.send('Error resigning')
             return
 
@@ -254,11 +373,7 @@ async def play(ctx, move):
         await ctx.send(f"The game {', '.join(black_team)} vs {', '.join(white_team)} is over")
 
         # Clean out save data
-        for p in black_team:
-            names_to_games.pop(p, None)
-        for p in white_team:
-            names_to_games.pop(p, None)
-        game_stats.pop(game, None)
+        remove_game(game)
 
         return
 
@@ -270,7 +385,15 @@ async def play(ctx, move):
             await ctx.send(f"{ctx.author.mention} invalid move {move}")
             return
 
-        if not game_manager.make_move(game, team_color, move):
+        if not rate_limit.acquire_ogs():
+            await ctx.send(BUSY_MESSAGE)
+            return
+        try:
+            success = await run_blocking(game_manager.make_move, game, team_color, move)
+        finally:
+            rate_limit.release_ogs()
+
+        if not success:
             await ctx.send('Error making move')
             return
 
@@ -284,6 +407,29 @@ async def play(ctx, move):
     next_player = game_stats[game]['players'][(team_turn + 1) % 2][(to_play + 1) % team_size]
     await ctx.send(f"{next_player} it is now your turn")
 
+@bot.command(name='play')
+@recorder.recorded('command', describe_command)
+async def play(ctx, move):
+    if not allowed_channel(ctx.message.channel) or not admit_command(ctx):
+        return
+
+    global names_to_games
+    global game_stats
+
+    # Ensure user is in a game
+    if ctx.author.mention not in names_to_games:
+        await ctx.send(f"{ctx.author.mention} you are not in a game")
+        return
+
+    game = names_to_games[ctx.author.mention]
+    async with get_game_lock(game):
+        # The game may have ended while waiting for the lock
+        if names_to_games.get(ctx.author.mention) != game:
+            await ctx.send(f"{ctx.author.mention} you are not in a game")
+            return
+
+        await play_turn(ctx, game, move)
+
 # -------------------- Main --------------------
 
 if __name__ == '__main__':
@@ -311,6 +457,10 @@ if __name__ == '__main__':
         settings['ogs_client_id'] = input('Enter OGS API client id: ')
         settings['ogs_client_secret'] = input('Enter ogs client secret: ')
 
+        # Rate limit settings
+        print('Using default rate limits')
+        settings['rate_limits'] = rate_limit.DEFAULT_LIMITS
+
         # Save for future runs
         save_settings()
         print('\nSuccessfully saved settings to settings.json')
@@ -318,6 +468,8 @@ if __name__ == '__main__':
     assert settings is not None, 'Error initializing settings'
 
     game_manager.load_config(settings['ogs_client_id'], settings['ogs_client_secret'])
+    rate_limit.load_config(settings)
+    recorder.load_config(settings)
     
     # Define variables that will be used
 
@@ -332,6 +484,8 @@ if __name__ == '__main__':
     #   num_moves: integer number of moves that have been played
     #   last_pass: bool that is True if the last move was a pass, False otherwise
     game_stats = {}
+    # A map of game id -> asyncio.Lock guarding that game's stats
+    game_locks = {}
 
     # Start bot
     bot.run(settings['discord_token'])
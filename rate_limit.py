@@ -0,0 +1,147 @@
+from typing import Dict, Hashable, Union
+
+import time
+
+# Default limits used when settings.json does not specify any
+# capacity is the largest burst allowed, refill_rate is the number of tokens regained per second
+DEFAULT_LIMITS = {
+    'user': {'capacity': 5, 'refill_rate': 0.5},
+    'channel': {'capacity': 20, 'refill_rate': 2},
+    'guild': {'capacity': 50, 'refill_rate': 5},
+    'max_ogs_in_flight': 4
+}
+
+# Number of buckets in a scope above which full buckets are removed
+MAX_BUCKETS = 1000
+
+# -------------------- Helper Classes --------------------
+
+# Simple token bucket. Starts full and regains refill_rate tokens per second up to capacity
+class TokenBucket:
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    # Add the tokens earned since the last refill
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    # Returns True if there is at least one token available
+    def has_token(self) -> bool:
+        self.refill()
+        return self.tokens >= 1
+
+    # Returns True if the bucket has refilled to capacity, making it the same as a new bucket
+    def is_full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+    def consume(self):
+        self.tokens -= 1
+
+# -------------------- Helper Functions --------------------
+
+# Method to remove the full buckets from a scope, since a full bucket is the same as a missing one
+def prune(scope: str):
+    global buckets
+
+    for key in [k for k, b in buckets[scope].items() if b.is_full()]:
+        del buckets[scope][key]
+
+# Gets the bucket for key within the given scope, creating a full one if it doesn't exist yet
+def get_bucket(scope: str, key: Hashable) -> TokenBucket:
+    global buckets
+    global limits
+
+    if key not in buckets[scope]:
+        if len(buckets[scope]) >= MAX_BUCKETS:
+            prune(scope)
+        buckets[scope][key] = TokenBucket(limits[scope]['capacity'], limits[scope]['refill_rate'])
+    return buckets[scope][key]
+
+# -------------------- Implementation --------------------
+
+# Method to load the limits from the settings dict, falling back to the defaults for anything missing
+# The refill rates are multiplied by refill_scale, which lets a replay sent faster than real time see the same limits
+def load_config(settings: Dict, refill_scale: float = 1):
+    global limits
+
+    configured = settings.get('rate_limits', {})
+
+    limits = {}
+    for key, default in DEFAULT_LIMITS.items():
+        if isinstance(default, dict):
+            limits[key] = dict(default)
+            limits[key].update(configured.get(key, {}))
+            limits[key]['refill_rate'] *= refill_scale
+        else:
+            limits[key] = configured.get(key, default)
+
+    reset()
+
+# Method to clear all buckets and counters
+def reset():
+    global buckets
+    global shed_counts
+    global ogs_in_flight
+
+    # A map of scope -> (a map of id -> TokenBucket)
+    buckets = {'user': {}, 'channel': {}, 'guild': {}}
+    # A map of reason -> number of requests that were rejected for that reason
+    shed_counts = {'user': 0, 'channel': 0, 'guild': 0, 'ogs_in_flight': 0}
+    ogs_in_flight = 0
+
+# Method to check if a command from the given user in the given channel and guild should be handled
+# A token is only taken from the buckets if every bucket has one available
+# guild_id may be None for direct messages
+# Returns True if the command is admitted
+def admit(user_id: int, channel_id: int, guild_id: Union[int, None]) -> bool:
+    global shed_counts
+
+    checks = [('user', user_id), ('channel', channel_id)]
+    if guild_id is not None:
+        checks.append(('guild', guild_id))
+
+    to_consume = []
+    for scope, key in checks:
+        bucket = get_bucket(scope, key)
+        if not bucket.has_token():
+            shed_counts[scope] += 1
+            return False
+        to_consume.append(bucket)
+
+    for bucket in to_consume:
+        bucket.consume()
+    return True
+
+# Method to reserve a slot for an operation that will call the OGS api
+# Every successful call must be paired with a call to release_ogs
+# Returns True if a slot was reserved, False if too many operations are already running
+def acquire_ogs() -> bool:
+    global ogs_in_flight
+    global shed_counts
+
+    if ogs_in_flight >= limits['max_ogs_in_flight']:
+        shed_counts['ogs_in_flight'] += 1
+        return False
+
+    ogs_in_flight += 1
+    return True
+
+# Method to release a slot reserved by acquire_ogs
+def release_ogs():
+    global ogs_in_flight
+
+    ogs_in_flight = max(0, ogs_in_flight - 1)
+
+# Method to get a copy of the counters of rejected requests
+def get_shed_counts() -> Dict[str, int]:
+    return dict(shed_counts)
+
+
+limits = dict(DEFAULT_LIMITS)
+reset()
@@ -0,0 +1,197 @@
+from typing import Any, Callable, Dict, Union
+from contextvars import ContextVar
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+
+# Default maximum size of the log before it is rotated, and the number of rotated logs to keep
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+
+# Extra details attached to the event currently being handled. Each asyncio task gets its own copy,
+#   so concurrently running handlers don't see each other's notes
+current_notes = ContextVar('current_notes', default=None)
+# Id of the command or reaction currently being handled, so OGS calls can be matched to the event that made them
+# Code that runs functions in other threads must copy the context for this to be seen there
+current_event = ContextVar('current_event', default=None)
+
+# Lock held while writing to the log, since OGS calls are recorded from other threads
+write_lock = threading.Lock()
+
+# -------------------- Helper Functions --------------------
+
+# Method to move the current log to path.1, shifting older logs up and dropping the oldest
+def rotate():
+    global log_file
+    global log_size
+
+    log_file.close()
+
+    for i in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{i}"):
+            os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+    if backups > 0:
+        os.replace(path, f"{path}.1")
+    else:
+        os.remove(path)
+
+    log_file = open(path, 'a')
+    log_size = 0
+
+# Default describe function, mapping the argument names of func to the values passed in
+def describe_args(func: Callable, *args, **kwargs) -> Dict[str, Any]:
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    return dict(bound.arguments)
+
+# -------------------- Implementation --------------------
+
+# Method to load the recorder settings from the settings dict
+# Recording is disabled unless record_path is set
+def load_config(settings: Dict):
+    global path
+    global max_bytes
+    global backups
+    global log_file
+    global log_size
+    global event_ids
+
+    path = settings.get('record_path')
+    max_bytes = settings.get('record_max_bytes', DEFAULT_MAX_BYTES)
+    backups = settings.get('record_backups', DEFAULT_BACKUPS)
+
+    if path is None:
+        return
+
+    log_file = open(path, 'a')
+    log_size = log_file.tell()
+
+    # Start the ids from the current time in milliseconds so they don't repeat across runs appending to the same log
+    event_ids = itertools.count(int(time.time() * 1000))
+
+# Method to check if events are being recorded
+def enabled() -> bool:
+    return path is not None
+
+# Method to close the log
+def close():
+    global path
+
+    with write_lock:
+        if path is None:
+            return
+
+        log_file.close()
+        path = None
+
+# Method to append a single event to the log
+# start is the wall clock time the event started and duration is in seconds
+# Handled events are given an event_id, while OGS calls record the id of the event that made them as parent
+def record(kind: str, name: str, details: Dict[str, Any], start: float, duration: float, outcome: Any, event_id: Union[int, None] = None, parent: Union[int, None] = None):
+    global log_size
+
+    event = {'t': round(start, 4), 'kind': kind, 'name': name, 'args': details, 'dur': round(duration, 4), 'out': outcome}
+    if event_id is not None:
+        event['id'] = event_id
+    if parent is not None:
+        event['parent'] = parent
+    line = json.dumps(event, separators=(',', ':'), default=str) + '\n'
+
+    with write_lock:
+        if path is None:
+            return
+
+        if log_size > 0 and log_size + len(line) > max_bytes:
+            rotate()
+
+        log_file.write(line)
+        log_file.flush()
+        log_size += len(line)
+
+# Method to attach an extra detail to the event currently being handled
+# Does nothing if there is no event being recorded
+def note(key: str, value: Any):
+    notes = current_notes.get()
+    if notes is not None:
+        notes[key] = value
+
+# Decorator to record every call of the decorated function as an event of the given kind
+# describe is called with the function's arguments and returns a dict of the details to record, or None if the call shouldn't be recorded.
+#   It may be a coroutine function. If it raises, the call is still made and recorded with the error in place of the details
+# Coroutine functions are treated as handled events and given an id, while regular functions record the id of the event that called them
+def recorded(kind: str, describe: Union[Callable, None] = None) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        def get_details(*args, **kwargs):
+            try:
+                if describe is None:
+                    return describe_args(func, *args, **kwargs)
+                return describe(*args, **kwargs)
+            except Exception as e:
+                return {'describe_error': type(e).__name__}
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if path is None:
+                    return await func(*args, **kwargs)
+
+                details = get_details(*args, **kwargs)
+                if inspect.isawaitable(details):
+                    try:
+                        details = await details
+                    except Exception as e:
+                        details = {'describe_error': type(e).__name__}
+                if details is None:
+                    return await func(*args, **kwargs)
+
+                event_id = next(event_ids)
+                notes_token = current_notes.set(details)
+                event_token = current_event.set(event_id)
+                start = time.time()
+                begin = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    record(kind, func.__name__, details, start, time.perf_counter() - begin, f"error:{type(e).__name__}", event_id=event_id)
+                    raise
+                finally:
+                    current_notes.reset(notes_token)
+                    current_event.reset(event_token)
+
+                record(kind, func.__name__, details, start, time.perf_counter() - begin, result, event_id=event_id)
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if path is None:
+                    return func(*args, **kwargs)
+
+                details = get_details(*args, **kwargs)
+                if details is None:
+                    return func(*args, **kwargs)
+
+                parent = current_event.get()
+                start = time.time()
+                begin = time.perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    record(kind, func.__name__, details, start, time.perf_counter() - begin, f"error:{type(e).__name__}", parent=parent)
+                    raise
+
+                record(kind, func.__name__, details, start, time.perf_counter() - begin, result, parent=parent)
+                return result
+
+        return wrapper
+    return decorator
+
+
+path = None
+max_bytes = DEFAULT_MAX_BYTES
+backups = DEFAULT_BACKUPS
+log_file = None
+log_size = 0
+event_ids = itertools.count()
@@ -0,0 +1,252 @@
+from typing import Any, Dict, List
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from discord.ext import commands
+
+import game_manager
+import main
+import rate_limit
+import recorder
+
+# -------------------- Stand-in Discord Objects --------------------
+
+# Only the attributes that the handlers in main.py use are provided
+
+class FakeRole:
+    def __init__(self, name: str):
+        self.name = name
+
+class FakeUser:
+    def __init__(self, mention: str, user_id: int = 0, roles: List[str] = ()):
+        self.mention = mention
+        self.id = user_id
+        self.roles = [FakeRole(r) for r in roles]
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+class FakeMessage:
+    def __init__(self, message_id: int, channel: 'FakeChannel', guild: FakeGuild = None):
+        self.id = message_id
+        self.channel = channel
+        self.guild = guild
+
+    async def add_reaction(self, emoji: str):
+        pass
+
+class FakeChannel:
+    def __init__(self, name: str, channel_id: int = 0, message_id: int = -1):
+        self.name = name
+        self.id = channel_id
+        # Id to give to sent messages, so reactions from the log line up with the challenge they were made on
+        self.message_id = message_id
+
+    async def send(self, content: str) -> FakeMessage:
+        return FakeMessage(self.message_id, self)
+
+class FakeContext:
+    def __init__(self, details: Dict[str, Any]):
+        self.author = FakeUser(details['user'], details['user_id'], details['roles'])
+        self.channel = FakeChannel(details['channel'], details['channel_id'], details.get('message_id', -1))
+        self.message = FakeMessage(-1, self.channel)
+        self.guild = FakeGuild(details['guild_id']) if details['guild_id'] is not None else None
+        self.send = self.channel.send
+
+class FakeReaction:
+    def __init__(self, details: Dict[str, Any]):
+        self.emoji = details['emoji']
+        guild = FakeGuild(details['guild_id']) if details['guild_id'] is not None else None
+        self.message = FakeMessage(details['message_id'], FakeChannel(details['channel'], details['channel_id']), guild)
+        self.reacted = [FakeUser(u) for u in details['reacted']]
+
+    def users(self):
+        return self
+
+    async def flatten(self) -> List[FakeUser]:
+        return self.reacted
+
+# -------------------- Stand-in OGS --------------------
+
+# Method to replace the OGS facing functions of game_manager with ones that answer from the log
+# Each call takes the outcome and duration of the next call with the same name recorded for the event being replayed,
+#   sleeping for duration * latency_scale
+# Calls beyond what was recorded for the event succeed immediately
+def install_stand_in_ogs(ogs_events: List[Dict[str, Any]], latency_scale: float):
+    queues = {}
+    for event in ogs_events:
+        queues.setdefault((event.get('parent'), event['name']), []).append(event)
+
+    new_game_ids = itertools.count(-2, -1)
+    defaults = {'start_game': lambda: next(new_game_ids)}
+
+    def make_stand_in(name: str):
+        def stand_in(*args, **kwargs):
+            queue = queues.get((recorder.current_event.get(), name), [])
+            if len(queue) == 0:
+                return defaults.get(name, lambda: True)()
+
+            event = queue.pop(0)
+            time.sleep(event['dur'] * latency_scale)
+            return event['out']
+        return stand_in
+
+    for name in ('start_game', 'make_move', 'pass_move', 'resign'):
+        setattr(game_manager, name, make_stand_in(name))
+
+# -------------------- Helper Functions --------------------
+
+# Method to load the events from the given logs, sorted by start time
+def load_events(paths: List[str]) -> List[Dict[str, Any]]:
+    events = []
+    for path in paths:
+        with open(path, 'r') as f:
+            events.extend(json.loads(line) for line in f if line.strip() != '')
+
+    events.sort(key=lambda e: e['t'])
+    return events
+
+# Method to get the handler in main.py for a recorded event
+def get_handler(name: str):
+    handler = getattr(main, name)
+    if isinstance(handler, commands.Command):
+        return handler.callback
+    return handler
+
+# Method to get the value at percentile p of a sorted list
+def percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+# Method to summarize a list of (name, duration) pairs and the total time they took
+def summarize(durations: List[tuple], total_time: float) -> Dict[str, Any]:
+    by_name = {}
+    for name, dur in durations:
+        by_name.setdefault(name, []).append(dur)
+
+    latency = {}
+    for name, values in by_name.items():
+        values.sort()
+        latency[name] = {'count': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'max': values[-1]}
+
+    return {
+            'events': len(durations),
+            'total_time': total_time,
+            'throughput': len(durations) / total_time if total_time > 0 else 0,
+            'latency': latency,
+            'shed': rate_limit.get_shed_counts()
+            }
+
+# Method to print a summary
+def print_summary(summary: Dict[str, Any]):
+    print(f"throughput (events/s): {summary['throughput']:.4f}")
+    for name in sorted(summary['latency']):
+        stats = summary['latency'][name]
+        print(f"{name} ({stats['count']} events)")
+        for stat in ('p50', 'p95', 'max'):
+            print(f"    {stat}: {stats[stat]:.4f}")
+    print(f"rejected by rate limits: {summary['shed']}")
+
+# Method to print the differences between two summaries
+def print_comparison(baseline: Dict[str, Any], current: Dict[str, Any]):
+    def change(old: float, new: float) -> str:
+        if old == 0:
+            return f"{old:.4f} -> {new:.4f}"
+        return f"{old:.4f} -> {new:.4f} ({(new - old) / old * 100:+.1f}%)"
+
+    print(f"throughput (events/s): {change(baseline['throughput'], current['throughput'])}")
+    for name in sorted(current['latency']):
+        if name not in baseline['latency']:
+            continue
+        old = baseline['latency'][name]
+        new = current['latency'][name]
+        print(f"{name} ({new['count']} events)")
+        for stat in ('p50', 'p95', 'max'):
+            print(f"    {stat}: {change(old[stat], new[stat])}")
+    print(f"rejected by rate limits: {baseline.get('shed')} -> {current['shed']}")
+
+# -------------------- Implementation --------------------
+
+# Method to feed the recorded events back through the handlers in main.py
+# speed is how many times faster than recorded the events are sent
+# Returns a summary of the latency and throughput of the replay
+async def replay(events: List[Dict[str, Any]], speed: float) -> Dict[str, Any]:
+    handled = [e for e in events if e['kind'] != 'ogs']
+    durations = []
+
+    async def run(event: Dict[str, Any]):
+        handler = get_handler(event['name'])
+        details = event['args']
+
+        # Lets the stand-in OGS functions find the calls recorded for this event
+        recorder.current_event.set(event.get('id'))
+
+        begin = time.perf_counter()
+        try:
+            if event['kind'] == 'reaction':
+                await handler(FakeReaction(details), FakeUser(details['user'], details.get('user_id', 0)))
+            else:
+                await handler(FakeContext(details), *details['args'])
+        except Exception as e:
+            print(f"Error replaying {event['name']}: {e}")
+        durations.append((event['name'], time.perf_counter() - begin))
+
+    tasks = []
+    start = time.perf_counter()
+    for event in handled:
+        # Wait until this event is due
+        delay = (event['t'] - handled[0]['t']) / speed - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(run(event)))
+
+    await asyncio.gather(*tasks)
+    return summarize(durations, time.perf_counter() - start)
+
+# -------------------- Main --------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a log recorded by the bot and report latency and throughput')
+    parser.add_argument('logs', nargs='+', help='recorded logs to replay, including any rotated logs')
+    parser.add_argument('--speed', type=float, default=1, help='how many times faster than recorded to send events')
+    parser.add_argument('--ogs-latency-scale', type=float, default=1, help='multiplier applied to the recorded OGS latencies')
+    parser.add_argument('--settings', help='settings file to take the channel, admin role, and rate limit settings from')
+    parser.add_argument('--output', help='file to save the summary of this run to')
+    parser.add_argument('--compare', help='summary saved by a previous replay to compare against')
+    args = parser.parse_args()
+
+    settings = {'discord_channels': [], 'discord_admin_roles': ['Admin', 'mod']}
+    if args.settings is not None:
+        with open(args.settings, 'r') as f:
+            settings.update(json.load(f))
+
+    events = load_events(args.logs)
+
+    # Set up the state that main.py normally creates on startup
+    main.settings = settings
+    main.waiting_reactions = {}
+    main.names_to_games = {}
+    main.game_stats = {}
+    main.game_locks = {}
+    rate_limit.load_config(settings, refill_scale=args.speed)
+    install_stand_in_ogs([e for e in events if e['kind'] == 'ogs'], args.ogs_latency_scale)
+
+    summary = asyncio.run(replay(events, args.speed))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+    # The timings in the log include Discord round trips that the replay doesn't make, so runs are only compared with other replays
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print(f"Comparing against {args.compare}")
+        print_comparison(baseline, summary)
+    else:
+        print_summary(summary)